@@ -1,6 +1,15 @@
 import aiohttp
+import asyncio
+import codecs
 import json
 import logging
+import time
+from yarl import URL
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from .exceptions import FullyKioskError
 
@@ -10,42 +19,132 @@ RESPONSE_STATUS = "status"
 RESPONSE_STATUSTEXT = "statustext"
 RESPONSE_ERRORSTATUS = "Error"
 
+SETTINGS_WRITE_COMMANDS = frozenset(("setStringSetting", "setBooleanSetting"))
+
+STREAM_CHUNK_SIZE = 65536
+
+# Only read-only commands are retried; anything else may already have
+# acted on the device when the response is lost.
+RETRY_COMMANDS = frozenset(("deviceInfo", "listSettings", "getCamshot", "getScreenshot"))
+RETRY_STATUSES = (502, 503, 504)
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 5
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+
+
+def _command(cmd):
+    """Create a FullyKiosk method that sends a command without arguments"""
+
+    async def command(self):
+        await self.sendCommand(cmd)
+
+    command.__name__ = cmd
+    command.__qualname__ = f"FullyKiosk.{cmd}"
+    return command
+
+
+def _is_binary(content_type):
+    return content_type.startswith("image/") or content_type == "application/octet-stream"
+
+
+def _binary_error(data, content_type):
+    """Build the error raised when JSON arrives where binary content was expected"""
+    if isinstance(data, dict) and data.get(RESPONSE_STATUS) == RESPONSE_ERRORSTATUS:
+        return FullyKioskError(RESPONSE_ERRORSTATUS, data.get(RESPONSE_STATUSTEXT))
+    return FullyKioskError(
+        RESPONSE_ERRORSTATUS, f"Unexpected content type: {content_type}"
+    )
+
 
 class FullyKiosk:
+    __slots__ = (
+        "_rh",
+        "_deviceInfo",
+        "_settings",
+        "_cache",
+        "_cacheGeneration",
+        "__weakref__",
+    )
+
     def __init__(self, session, host, port, password, use_ssl=False, verify_ssl=False):
         if not use_ssl:
             verify_ssl = False
+        base_params = {"type": "json"}
+        if password is not None:
+            base_params["password"] = str(password)
         self._rh = _RequestsHandler(session, host, port, use_ssl=use_ssl,
-                                    verify_ssl=verify_ssl)
-        self._password = password
+                                    verify_ssl=verify_ssl, base_params=base_params)
         self._deviceInfo = None
         self._settings = None
+        self._cache = {}
+        self._cacheGeneration = 0
+
+    @classmethod
+    def create(cls, host, port, password, use_ssl=False, verify_ssl=False):
+        """Create a FullyKiosk that manages its own keep-alive session.
+        Call close() when done with it.
+        """
+        return cls(None, host, port, password, use_ssl=use_ssl, verify_ssl=verify_ssl)
 
     async def sendCommand(self, cmd, **kwargs):
-        data = await self._rh.get(
-            cmd=cmd, password=self._password, type="json", **kwargs
-        )
+        if cmd in SETTINGS_WRITE_COMMANDS:
+            try:
+                return await self._sendCommand(cmd, kwargs)
+            finally:
+                # Also discards listSettings fetches that overlapped the write
+                self._cacheGeneration += 1
+                self._cache.pop("listSettings", None)
+        return await self._sendCommand(cmd, kwargs)
+
+    async def _sendCommand(self, cmd, kwargs):
+        data = await self._rh.get(cmd, **kwargs)
 
         if (
             isinstance(data, dict)
-            and RESPONSE_STATUS in data
-            and data[RESPONSE_STATUS] == RESPONSE_ERRORSTATUS
+            and data.get(RESPONSE_STATUS) == RESPONSE_ERRORSTATUS
         ):
             raise FullyKioskError(RESPONSE_ERRORSTATUS, data[RESPONSE_STATUSTEXT])
         return data
 
+    async def sendBatch(self, cmds):
+        """Send several commands concurrently over the shared session.
+        cmds is an iterable of (cmd, kwargs) pairs; results are returned in order.
+        """
+        return await asyncio.gather(
+            *(self.sendCommand(cmd, **kwargs) for cmd, kwargs in cmds)
+        )
+
     # REST API Documentation: https://www.fully-kiosk.com/en/#rest
 
-    async def getDeviceInfo(self):
-        result = await self.sendCommand("deviceInfo")
+    async def _cachedCommand(self, cmd, ttl):
+        """Return the result of cmd, reusing one fetched less than ttl seconds ago"""
+        if not ttl:
+            return await self.sendCommand(cmd)
+        cached = self._cache.get(cmd)
+        if cached is not None and time.monotonic() - cached[0] < ttl:
+            return cached[1]
+        generation = self._cacheGeneration
+        fetched = time.monotonic()
+        result = await self.sendCommand(cmd)
+        if generation == self._cacheGeneration:
+            self._cache[cmd] = (fetched, result)
+        return result
+
+    async def getDeviceInfo(self, ttl=0):
+        result = await self._cachedCommand("deviceInfo", ttl)
         self._deviceInfo = result
         return self._deviceInfo
 
-    async def getSettings(self):
-        result = await self.sendCommand("listSettings")
+    async def getSettings(self, ttl=0):
+        result = await self._cachedCommand("listSettings", ttl)
         self._settings = result
         return self._settings
 
+    async def close(self):
+        await self._rh.close()
+
     @property
     def deviceInfo(self):
         return self._deviceInfo
@@ -62,30 +161,25 @@ class FullyKiosk:
     async def setConfigurationBool(self, setting, boolValue):
         await self.sendCommand("setBooleanSetting", key=setting, value=boolValue)
 
-    # Screen, screensaver
-
-    async def screenOn(self):
-        await self.sendCommand("screenOn")
-
-    async def screenOff(self):
-        await self.sendCommand("screenOff")
-
-    async def forceSleep(self):
-        await self.sendCommand("forceSleep")
+    async def setConfigurationMany(self, strings=None, bools=None):
+        """Apply several string and boolean settings concurrently"""
+        await self.sendBatch(
+            [("setStringSetting", {"key": k, "value": v}) for k, v in (strings or {}).items()]
+            + [("setBooleanSetting", {"key": k, "value": v}) for k, v in (bools or {}).items()]
+        )
 
-    async def startScreensaver(self):
-        await self.sendCommand("startScreensaver")
+    # Screen, screensaver
 
-    async def stopScreensaver(self):
-        await self.sendCommand("stopScreensaver")
+    screenOn = _command("screenOn")
+    screenOff = _command("screenOff")
+    forceSleep = _command("forceSleep")
+    startScreensaver = _command("startScreensaver")
+    stopScreensaver = _command("stopScreensaver")
 
     # Daydream: max Android 12
 
-    async def startDaydream(self):
-        await self.sendCommand("startDaydream")
-
-    async def stopDaydream(self):
-        await self.sendCommand("stopDaydream")
+    startDaydream = _command("startDaydream")
+    stopDaydream = _command("stopDaydream")
 
     async def setScreenBrightness(self, brightness):
         await self.setConfigurationString("screenBrightness", brightness)
@@ -98,80 +192,52 @@ class FullyKiosk:
     async def playSound(self, url, stream=None):
         await self.sendCommand("playSound", url=url, stream=stream)
 
-    async def stopSound(self):
-        await self.sendCommand("stopSound")
+    stopSound = _command("stopSound")
 
     async def textToSpeech(self, text, locale=None, engine=None, queue=None):
         if queue is not None:
             queue = "1" if queue else "0"
         await self.sendCommand("textToSpeech", text=text, locale=locale, engine=engine, queue=queue)
 
-    async def stopTextToSpeech(self):
-        await self.sendCommand("stopTextToSpeech")
+    stopTextToSpeech = _command("stopTextToSpeech")
 
     # Lock, maintenance
 
-    async def lockKiosk(self):
-        await self.sendCommand("lockKiosk")
-
-    async def unlockKiosk(self):
-        await self.sendCommand("unlockKiosk")
-
-    async def enableLockedMode(self):
-        await self.sendCommand("enableLockedMode")
-
-    async def disableLockedMode(self):
-        await self.sendCommand("disableLockedMode")
+    lockKiosk = _command("lockKiosk")
+    unlockKiosk = _command("unlockKiosk")
+    enableLockedMode = _command("enableLockedMode")
+    disableLockedMode = _command("disableLockedMode")
 
     # Root only:
 
-    async def rebootDevice(self):
-        await self.sendCommand("rebootDevice")
+    rebootDevice = _command("rebootDevice")
 
     # App management
 
-    async def restartApp(self):
-        await self.sendCommand("restartApp")
-
-    async def exitApp(self):
-        await self.sendCommand("exitApp")
-
-    async def killMyProcess(self):
-        await self.sendCommand("killMyProcess")
-
-    async def toForeground(self):
-        await self.sendCommand("toForeground")
-
-    async def toBackground(self):
-        await self.sendCommand("toBackground")
+    restartApp = _command("restartApp")
+    exitApp = _command("exitApp")
+    killMyProcess = _command("killMyProcess")
+    toForeground = _command("toForeground")
+    toBackground = _command("toBackground")
 
     async def startApplication(self, application):
         await self.sendCommand("startApplication", package=application)
 
     # Web browsing
 
-    async def loadStartUrl(self):
-        await self.sendCommand("loadStartUrl")
+    loadStartUrl = _command("loadStartUrl")
 
     async def loadUrl(self, url):
         await self.sendCommand("loadUrl", url=url)
 
-    async def clearCache(self):
-        await self.sendCommand("clearCache")
-
-    async def clearWebstorage(self):
-        await self.sendCommand("clearWebstorage")
-
-    async def clearCookies(self):
-        await self.sendCommand("clearCookies")
-
-    async def resetWebview(self):
-        await self.sendCommand("resetWebview")
+    clearCache = _command("clearCache")
+    clearWebstorage = _command("clearWebstorage")
+    clearCookies = _command("clearCookies")
+    resetWebview = _command("resetWebview")
 
     # Motion detection
 
-    async def triggerMotion(self):
-        await self.sendCommand("triggerMotion")
+    triggerMotion = _command("triggerMotion")
 
     async def enableMotionDetection(self):
         await self.setConfigurationBool("motionDetection", True)
@@ -182,49 +248,158 @@ class FullyKiosk:
     # Camera, screenshot:
 
     async def getCamshot(self):
-        return await self.sendCommand("getCamshot")
+        return await self._rh.get_bytes("getCamshot")
 
     async def getScreenshot(self):
-        return await self.sendCommand("getScreenshot")
+        return await self._rh.get_bytes("getScreenshot")
+
+    def getCamshotStream(self):
+        return self._rh.get_stream("getCamshot")
+
+    def getScreenshotStream(self):
+        return self._rh.get_stream("getScreenshot")
 
 
 class _RequestsHandler:
     """Internal class to create FullyKiosk requests"""
 
+    __slots__ = (
+        "headers",
+        "session",
+        "host",
+        "port",
+        "use_ssl",
+        "verify_ssl",
+        "_base_params",
+        "_cmd_urls",
+        "_owns_session",
+        "_req_kwargs",
+        "_url",
+        "__weakref__",
+    )
+
     def __init__(self, session: aiohttp.ClientSession, host, port, use_ssl=False,
-                 verify_ssl=False):
+                 verify_ssl=False, base_params=None):
         self.headers = {"Accept": "application/json"}
+        self._base_params = base_params or {}
+        self._cmd_urls = {}
 
         self.session = session
+        self._owns_session = session is None
         self.host = host
         self.port = port
         self.use_ssl = use_ssl
         self.verify_ssl = verify_ssl
+        self._url = URL(f"http{'s' if use_ssl else ''}://{host}:{port}")
+        self._req_kwargs = {"headers": self.headers}
+        if not verify_ssl:
+            self._req_kwargs["ssl"] = False
+
+    def _get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=4, limit_per_host=4, keepalive_timeout=75, ttl_dns_cache=300
+                ),
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
+        return self.session
+
+    async def close(self):
+        """Close the session if it was created by this handler"""
+        if self._owns_session and self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def _request(self, cmd, kwargs):
+        extra = [
+            (key, value if isinstance(value, str) else str(value))
+            for key, value in kwargs.items()
+            if value is not None
+        ]
+        if extra:
+            params = {"cmd": cmd, **self._base_params}
+            params.update(extra)
+            url = self._url.with_query(params)
+        else:
+            # Commands without arguments always encode to the same URL
+            url = self._cmd_urls.get(cmd)
+            if url is None:
+                url = self._cmd_urls[cmd] = self._url.with_query(
+                    {"cmd": cmd, **self._base_params}
+                )
 
-    async def get(self, **kwargs):
-        url = f"http{'s' if self.use_ssl else ''}://{self.host}:{self.port}"
-        params = []
-
-        for key, value in kwargs.items():
-            if value is not None:
-                params.append((key, str(value)))
-        req_params = {"url": url, "headers": self.headers, "params": params}
-        if not self.verify_ssl:
-            req_params["ssl"] = False
-
-        _LOGGER.debug("Sending request to: %s", url)
-        _LOGGER.debug("Parameters: %s", params)
-        async with self.session.get(**req_params) as response:
-            if response.status != 200:
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Sending request to: %s", self._url)
+            params = dict(url.query)
+            if "password" in params:
+                params["password"] = "********"
+            _LOGGER.debug("Parameters: %s", params)
+        session = self._get_session()
+        retries = MAX_RETRIES if cmd in RETRY_COMMANDS else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(
+                    min(RETRY_BACKOFF * 2 ** (attempt - 1), RETRY_BACKOFF_MAX)
+                )
+            try:
+                response = await session.get(url, **self._req_kwargs)
+            except aiohttp.ClientConnectorError as err:
+                if attempt == retries:
+                    raise
+                _LOGGER.debug("Request to Fully Kiosk Browser failed, retrying: %s", err)
+                continue
+            if response.status in RETRY_STATUSES and attempt < retries:
+                response.release()
+                _LOGGER.debug(
+                    "Fully Kiosk Browser returned %s, retrying", response.status
+                )
+                continue
+            break
+        if response.status != 200:
+            async with response:
                 _LOGGER.warning(
                     "Invalid response from Fully Kiosk Browser API: %s", response.status
                 )
                 raise FullyKioskError(response.status, await response.text())
-
-            content_type = response.headers['Content-Type']
-            if content_type.startswith("image/") or content_type == "application/octet-stream":
-                return await response.content.read()
-            data = await response.json(content_type=content_type)
-
-            _LOGGER.debug(json.dumps(data))
-            return data
+        return response
+
+    @staticmethod
+    async def _read_json(response):
+        raw = (await response.read()).strip()
+        if not raw:
+            return None
+
+        encoding = response.get_encoding()
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug(raw.decode(encoding, errors="replace"))
+        if codecs.lookup(encoding).name != "utf-8":
+            return _json_loads(raw.decode(encoding))
+        return _json_loads(raw)
+
+    async def get(self, cmd, **kwargs):
+        response = await self._request(cmd, kwargs)
+        async with response:
+            if _is_binary(response.content_type):
+                return await response.read()
+            return await self._read_json(response)
+
+    async def get_bytes(self, cmd, **kwargs):
+        """Send a command that is expected to return binary content"""
+        response = await self._request(cmd, kwargs)
+        async with response:
+            if _is_binary(response.content_type):
+                return await response.read()
+            data = await self._read_json(response)
+        raise _binary_error(data, response.content_type)
+
+    async def get_stream(self, cmd, **kwargs):
+        """Send a command and yield its binary content in chunks as it arrives"""
+        response = await self._request(cmd, kwargs)
+        async with response:
+            if _is_binary(response.content_type):
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    yield chunk
+                return
+            data = await self._read_json(response)
+        raise _binary_error(data, response.content_type)
@@ -22,6 +22,7 @@ setup(
     python_requires=">=3.6",
     include_package_data=True,
     zip_safe=False,
+    extras_require={"fast": ["orjson"]},
     classifiers=[
         "Development Status :: 4 - Beta",
         "Intended Audience :: Developers",